@@ -1,35 +1,58 @@
 from configparser import ConfigParser
 import copy
+import warnings
 
 import flask
 import pytest
 import re
+import yaml
 from pytest_mock import MockerFixture
 import time
 from typing import List, Dict
-import urllib, urllib.parse
 
 # Rewrites the path so the app can be imported like it normally is
 import os
+import pathlib
 import sys
 
-topdir = os.path.join(os.path.dirname(__file__), "..")
+topdir = os.fspath(pathlib.Path(__file__).resolve().parent.parent)
 sys.path.append(topdir)
 
 os.environ['TESTING'] = "True"
 
 from app import app, global_data
-from webapp import models, topology, vos_data
+from webapp import models, topology, vos_data, x509
 from webapp.common import load_yaml_file, NamespacesFilters
-from webapp.data_federation import CredentialGeneration, StashCache
+from webapp.data_federation import CredentialGeneration
 import stashcache
 
-HOST_PORT_RE = re.compile(r"[a-zA-Z0-9.-]{3,63}:[0-9]{2,5}")
-PROTOCOL_HOST_PORT_RE = re.compile(r"[a-z]+://" + HOST_PORT_RE.pattern)
-
-GRID_MAPPING_REGEX = re.compile(r'^"(/[^"]*CN=[^"]+")\s+([0-9a-f]{8}[.]0)$')
-# ^^ the DN starts with a slash and will at least have a CN in it.
-EMPTY_LINE_REGEX = re.compile(r'^\s*(#|$)')  # Empty or comment-only lines
+HOST_PORT_RE = re.compile(r"\A[a-zA-Z0-9.-]{3,63}:[0-9]{2,5}\Z")
+PROTOCOL_HOST_PORT_RE = re.compile(r"\A[a-z]+://" + HOST_PORT_RE.pattern[2:])
+# ^^ anchored so non-matching input is rejected without scanning the whole string
+
+MAPFILE_LINE_RE = re.compile(
+    r'(?P<empty>^[ \t]*(?:#.*)?$)'
+    r'|(?P<map>^"/[^"]*CN=(?P<cn>[^/"]+)"[ \t]+[0-9a-f]{8}[.]0$)'
+    r'|^.*$',
+    re.MULTILINE)
+# ^^ classifies each mapfile line in one pass over the whole buffer: either
+# empty/comment-only ("empty"), a grid mapping ("map" -- the DN starts with a
+# slash and "cn" captures the value of its last CN component), or unexpected
+# text (the catch-all alternative, where neither named group matches).
+NONEMPTY_LINE_RE = re.compile(r'^[ \t]*[^#\s].*$', re.MULTILINE)
+# ^^ any line with content that isn't a comment; lets the regex engine walk
+# the whole mapfile in one pass instead of splitting it into a line list
+ISSUER_RE = re.compile(r"\Ahttps://([^/?#]+)")
+# ^^ an https URL with a non-empty netloc; cheaper than urllib.parse.urlparse
+
+
+_ALLOWED_NO_FQDN_CNS = frozenset({
+    "Brian Paul Bockelman",
+    "Matyas Selmeci A148276",
+    "Judith Lorraine Stephen",
+})
+# ^^ these three have their FQANs explicitly allowed in some namespaces so it's
+# OK for them to show up in grid-mapfiles even without an FQDN
 I2_TEST_CACHE = "osg-sunnyvale-stashcache.nrp.internet2.edu"
 # ^^ one of the Internet2 caches; these serve both public and LIGO data
 # fake origins in our test data:
@@ -41,6 +64,11 @@ TEST_ORIGIN_AUTH2000 = "origin-auth2000.test.wisc.edu"
 TEST_ISSUER = "https://test.wisc.edu"
 TEST_BASEPATH = "/testvo"
 
+TEST_DATA_DIR = os.path.join(topdir, "tests", "data")
+TESTRG_PATH = os.path.join(TEST_DATA_DIR, "testrg.yaml")
+TESTRG_DOWNTIME_PATH = os.path.join(TEST_DATA_DIR, "testrg_downtime.yaml")
+TESTVO_PATH = os.path.join(TEST_DATA_DIR, "testvo.yaml")
+
 # Some DNs I can use for testing and the hashes they map to.
 # All of these were generated with osg-ca-generator on alma8
 #   openssl x509 -in /etc/grid-security/hostcert.pem -noout -subject -nameopt compat
@@ -56,20 +84,44 @@ MOCK_DNS_AND_HASHES = {
 MOCK_DN_LIST = list(MOCK_DNS_AND_HASHES.keys())
 
 
-@pytest.fixture
+def _mock_generate_dn_hash(dn: str) -> str:
+    """Serve the precomputed hashes for the mock DNs, falling back to the
+    real subject-hash derivation for DNs from the topology data"""
+    try:
+        return MOCK_DNS_AND_HASHES[dn]
+    except KeyError:
+        return x509.generate_dn_hash(dn)
+
+if not yaml.__with_libyaml__:
+    warnings.warn("PyYAML was built without libyaml; YAML-heavy fixtures will be slow")
+
+
+@pytest.fixture(scope="module")
 def test_global_data() -> models.GlobalData:
-    """Get a copy of the global data with some entries created for testing"""
-    new_global_data = copy.deepcopy(global_data)
+    """Get a copy of the global data with some entries created for testing.
+
+    Module-scoped since building the testing GlobalData is expensive and
+    the tests only read from it; use a function-scoped copy if a test ever
+    needs to mutate it.
+    """
+    # A deepcopy of the whole GlobalData is expensive and unnecessary: only
+    # the topology and VO data get modified, so shallow-copy everything and
+    # force those two caches to rebuild fresh objects from the data dirs.
+    new_global_data = copy.copy(global_data)
+    new_global_data.topology = copy.copy(global_data.topology)
+    new_global_data.vos_data = copy.copy(global_data.vos_data)
+    new_global_data.topology.force_update = True
+    new_global_data.vos_data.force_update = True
 
     # Start with a fully populated set of topology data
     topo = new_global_data.get_topology()
     assert isinstance(topo, topology.Topology), "Unable to get Topology data"
 
     # Add our testing RG
-    testrg = load_yaml_file(topdir + "/tests/data/testrg.yaml")
+    testrg = load_yaml_file(TESTRG_PATH)
     topo.add_rg("University of Wisconsin", "CHTC", "testrg", testrg)
 
-    testrg_downtime = load_yaml_file(topdir + "/tests/data/testrg_downtime.yaml")
+    testrg_downtime = load_yaml_file(TESTRG_DOWNTIME_PATH)
     topo.add_downtime("CHTC", "testrg", testrg_downtime)
 
     # Put it back into global_data2 and make sure it doesn't get overwritten by future calls
@@ -81,7 +133,7 @@ def test_global_data() -> models.GlobalData:
     assert isinstance(vos, vos_data.VOsData), "Unable to get VO data"
 
     # Load our testing VO
-    testvo = load_yaml_file(topdir + "/tests/data/testvo.yaml")
+    testvo = load_yaml_file(TESTVO_PATH)
     vos.add_vo("testvo", testvo)
 
     # Put it back into global_data2 and make sure it doesn't get overwritten by future calls
@@ -91,65 +143,73 @@ def test_global_data() -> models.GlobalData:
     return new_global_data
 
 
-@pytest.fixture
+@pytest.fixture(scope="module")
 def ligo_stashcache():
     vos_data = global_data.get_vos_data()
     return vos_data.stashcache_by_vo_name["LIGO"]
 
 
-@pytest.fixture
+@pytest.fixture(scope="module")
+def num_ligo_auth_namespaces(ligo_stashcache):
+    """Number of LIGO namespaces that require auth; computed once since
+    is_public() gets called for every namespace"""
+    return len([ns for ns in ligo_stashcache.namespaces.values() if not ns.is_public()])
+
+
+@pytest.fixture(scope="module")
 def client():
+    # the tests here only take the client to make sure the app is set up;
+    # none of them mutate client state, so one per module is enough
     with app.test_client() as client:
         yield client
 
 
 class TestStashcache:
 
-    def test_allowedVO_includes_ANY_for_ligo_inclusion(self,
-                                                       client: flask.Flask,
-                                                       mocker: MockerFixture,
-                                                       ligo_stashcache: StashCache):
-        num_auth_namespaces = len([ns for ns in ligo_stashcache.namespaces.values() if not ns.is_public()])
-
-        spy = mocker.spy(global_data, "get_ligo_dn_list")
-
-        stashcache.generate_cache_authfile(global_data, "osg-sunnyvale-stashcache.nrp.internet2.edu")
-
-        assert spy.call_count == num_auth_namespaces
-
-    def test_allowedVO_includes_LIGO_for_ligo_inclusion(self,
-                                                        client: flask.Flask,
-                                                        mocker: MockerFixture,
-                                                        ligo_stashcache: StashCache):
-        num_auth_namespaces = len([ns for ns in ligo_stashcache.namespaces.values() if not ns.is_public()])
-
-        spy = mocker.spy(global_data, "get_ligo_dn_list")
-
-        stashcache.generate_cache_authfile(global_data, "stashcache.gwave.ics.psu.edu")
-
-        assert spy.call_count == num_auth_namespaces
-
-    def test_allowedVO_excludes_LIGO_and_ANY_for_ligo_inclusion(self, client: flask.Flask, mocker: MockerFixture):
-        spy = mocker.spy(global_data, "get_ligo_dn_list")
-
-        stashcache.generate_cache_authfile(global_data, "rds-cache.sdsc.edu")
-
-        assert spy.call_count == 0
+    @pytest.mark.parametrize("fqdn, expects_ligo_dns", [
+        (I2_TEST_CACHE, True),  # allowed VOs include ANY
+        ("stashcache.gwave.ics.psu.edu", True),  # allowed VOs include LIGO
+        ("rds-cache.sdsc.edu", False),  # allowed VOs exclude both LIGO and ANY
+    ])
+    def test_allowedVO_ligo_inclusion(self,
+                                      client: flask.Flask,
+                                      monkeypatch: pytest.MonkeyPatch,
+                                      num_ligo_auth_namespaces: int,
+                                      fqdn: str,
+                                      expects_ligo_dns: bool):
+        # a plain counting wrapper is much cheaper than a mocker.spy, which
+        # records args/kwargs for every call
+        call_count = [0]
+        orig_get_ligo_dn_list = global_data.get_ligo_dn_list
+
+        def counting_get_ligo_dn_list(*args, **kwargs):
+            call_count[0] += 1
+            return orig_get_ligo_dn_list(*args, **kwargs)
+
+        monkeypatch.setattr(global_data, "get_ligo_dn_list", counting_get_ligo_dn_list)
+
+        stashcache.generate_cache_authfile(global_data, fqdn)
+
+        if expects_ligo_dns:
+            assert call_count[0] == num_ligo_auth_namespaces
+        else:
+            assert call_count[0] == 0
 
     def test_scitokens_issuer_sections(self, test_global_data):
         origin_scitokens_conf = stashcache.generate_origin_scitokens(
             test_global_data, TEST_ITB_HELM_ORIGIN)
         assert origin_scitokens_conf.strip(), "Generated scitokens.conf empty"
 
-        cp = ConfigParser()
-        cp.read_string(origin_scitokens_conf, "origin_scitokens.conf")
-
         try:
-            assert "Global" in cp, "Missing Global section"
-            assert "Issuer https://test.wisc.edu" in cp, \
+            # cheap substring probes for section existence; only parse the
+            # whole config when a value needs to be read out of it
+            assert "[Global]" in origin_scitokens_conf, "Missing Global section"
+            assert "[Issuer https://test.wisc.edu]" in origin_scitokens_conf, \
                 "Issuer missing"
-            assert "Issuer https://test.wisc.edu/issuer2" in cp, \
+            assert "[Issuer https://test.wisc.edu/issuer2]" in origin_scitokens_conf, \
                 "Issuer 2 missing"
+            cp = ConfigParser()
+            cp.read_string(origin_scitokens_conf, "origin_scitokens.conf")
             assert "base_path" in cp["Issuer https://test.wisc.edu/issuer2"], \
                 "Issuer 2 base_path missing"
             assert cp["Issuer https://test.wisc.edu/issuer2"]["base_path"] == "/testvo/issuer2test", \
@@ -178,12 +238,12 @@ class TestStashcache:
             test_global_data, TEST_SC_ORIGIN)
         assert origin_scitokens_conf.strip(), "Generated scitokens.conf empty"
 
-        cp = ConfigParser()
-        cp.read_string(origin_scitokens_conf, "origin_scitokens.conf")
         try:
-            assert "Global" in cp, "Missing Global section"
-            assert "Issuer https://test.wisc.edu" in cp, \
+            assert "[Global]" in origin_scitokens_conf, "Missing Global section"
+            assert "[Issuer https://test.wisc.edu]" in origin_scitokens_conf, \
                 "Expected issuer missing"
+            cp = ConfigParser()
+            cp.read_string(origin_scitokens_conf, "origin_scitokens.conf")
             assert "base_path" in cp["Issuer https://test.wisc.edu"], \
                 "'Issuer https://test.wisc.edu' section missing expected attribute"
             assert cp["Issuer https://test.wisc.edu"]["base_path"] == "/testvo", \
@@ -197,60 +257,53 @@ class TestStashcache:
 
     def test_origin_grid_mapfile_nohost(self, client: flask.Flask):
         text = stashcache.generate_origin_grid_mapfile(global_data, "", suppress_errors=False)
-        for line in text.split("\n"):
-            assert EMPTY_LINE_REGEX.match(line), f'Unexpected text "{line}".\nFull text:\n{text}\n'
+        mm = NONEMPTY_LINE_RE.search(text)
+        assert not mm, f'Unexpected text "{mm.group(0) if mm else ""}".\nFull text:\n{text}\n'
 
     def test_cache_grid_mapfile_nohost(self, client: flask.Flask):
         text = stashcache.generate_cache_grid_mapfile(global_data, "", legacy=False, suppress_errors=False)
 
-        for line in text.split("\n"):
-            if EMPTY_LINE_REGEX.match(line):
+        for mm in MAPFILE_LINE_RE.finditer(text):
+            if mm.group("empty") is not None:
+                continue
+            elif mm.group("map") is not None and mm.group("cn") in _ALLOWED_NO_FQDN_CNS:
                 continue
-            mm = GRID_MAPPING_REGEX.match(line)
-            if mm:
-                dn = mm.group(1)
-                if "CN=Brian Paul Bockelman" in dn or "CN=Matyas Selmeci A148276" in dn or "CN=Judith Lorraine Stephen" in dn:
-                    # HACK: these three have their FQANs explicitly allowed in some namespaces so it's OK
-                    # for them to show up in grid-mapfiles even without an FQDN
-                    continue
-                else:
-                    assert False, f'Unexpected text "{line}".\nFull text:\n{text}\n'
             else:
-                assert False, f'Unexpected text "{line}".\nFull text:\n{text}\n'
+                assert False, f'Unexpected text "{mm.group(0)}".\nFull text:\n{text}\n'
 
     def test_cache_grid_mapfile_i2_cache(self, client: flask.Flask, mocker: MockerFixture):
         mocker.patch.object(global_data, "get_ligo_dn_list", return_value=MOCK_DN_LIST, autospec=True)
+        mocker.patch("webapp.data_federation.generate_dn_hash", _mock_generate_dn_hash)
         text = stashcache.generate_cache_grid_mapfile(global_data,
                                                       I2_TEST_CACHE,
                                                       legacy=True,
                                                       suppress_errors=False)
         num_mappings = 0
-        for line in text.split("\n"):
-            if EMPTY_LINE_REGEX.match(line):
-                continue
-            elif GRID_MAPPING_REGEX.match(line):
+        for mm in MAPFILE_LINE_RE.finditer(text):
+            if mm.group("map") is not None:
                 num_mappings += 1
             else:
-                assert False, f'Unexpected text "{line}".\nFull text:\n{text}\n'
+                assert mm.group("empty") is not None, \
+                    f'Unexpected text "{mm.group(0)}".\nFull text:\n{text}\n'
         assert num_mappings > 5, f"Too few mappings found.\nFull text:\n{text}\n"
 
 
 class TestNamespaces:
-    @pytest.fixture
+    @pytest.fixture(scope="module")
     def namespaces_json(self, test_global_data) -> Dict:
         return stashcache.get_namespaces_info(test_global_data)
 
-    @pytest.fixture
+    @pytest.fixture(scope="module")
     def namespaces(self, namespaces_json) -> List[Dict]:
         assert "namespaces" in namespaces_json
         return namespaces_json["namespaces"]
 
-    @pytest.fixture
+    @pytest.fixture(scope="module")
     def caches(self, namespaces_json) -> List[Dict]:
         assert "caches" in namespaces_json
         return namespaces_json["caches"]
 
-    @pytest.fixture
+    @pytest.fixture(scope="module")
     def caches_include_inactive(self, test_global_data) -> List[Dict]:
         filters = NamespacesFilters()
         filters.include_inactive = True
@@ -258,7 +311,7 @@ class TestNamespaces:
         assert "caches" in namespaces_json
         return namespaces_json["caches"]
 
-    @pytest.fixture
+    @pytest.fixture(scope="module")
     def caches_include_downed(self, test_global_data) -> List[Dict]:
         filters = NamespacesFilters()
         filters.include_downed = True
@@ -266,7 +319,7 @@ class TestNamespaces:
         assert "caches" in namespaces_json
         return namespaces_json["caches"]
 
-    @pytest.fixture
+    @pytest.fixture(scope="module")
     def caches_production(self, test_global_data) -> List[Dict]:
         filters = NamespacesFilters()
         filters.production = True
@@ -275,7 +328,7 @@ class TestNamespaces:
         assert "caches" in namespaces_json
         return namespaces_json["caches"]
 
-    @pytest.fixture
+    @pytest.fixture(scope="module")
     def caches_itb(self, test_global_data) -> List[Dict]:
         filters = NamespacesFilters()
         filters.production = False
@@ -284,10 +337,30 @@ class TestNamespaces:
         assert "caches" in namespaces_json
         return namespaces_json["caches"]
 
+    @pytest.fixture(scope="module")
+    def caches_resources(self, caches) -> frozenset:
+        return frozenset(c["resource"] for c in caches)
+
+    @pytest.fixture(scope="module")
+    def caches_include_inactive_resources(self, caches_include_inactive) -> frozenset:
+        return frozenset(c["resource"] for c in caches_include_inactive)
+
+    @pytest.fixture(scope="module")
+    def caches_include_downed_resources(self, caches_include_downed) -> frozenset:
+        return frozenset(c["resource"] for c in caches_include_downed)
+
+    @pytest.fixture(scope="module")
+    def caches_production_resources(self, caches_production) -> frozenset:
+        return frozenset(c["resource"] for c in caches_production)
+
+    @pytest.fixture(scope="module")
+    def caches_itb_resources(self, caches_itb) -> frozenset:
+        return frozenset(c["resource"] for c in caches_itb)
+
     @staticmethod
     def validate_cache_schema(cc):
-        assert HOST_PORT_RE.match(cc["auth_endpoint"])
-        assert HOST_PORT_RE.match(cc["endpoint"])
+        assert HOST_PORT_RE.fullmatch(cc["auth_endpoint"])
+        assert HOST_PORT_RE.fullmatch(cc["endpoint"])
         assert cc["resource"] and isinstance(cc["resource"], str)
         assert "production" in cc and isinstance(cc["production"], (type(None), bool))
 
@@ -297,15 +370,14 @@ class TestNamespaces:
         assert ns["path"].startswith("/")  # implies str
         assert isinstance(ns["readhttps"], bool)
         assert isinstance(ns["usetokenonread"], bool)
-        assert ns["dirlisthost"] is None or PROTOCOL_HOST_PORT_RE.match(ns["dirlisthost"])
-        assert ns["writebackhost"] is None or PROTOCOL_HOST_PORT_RE.match(ns["writebackhost"])
+        assert ns["dirlisthost"] is None or PROTOCOL_HOST_PORT_RE.fullmatch(ns["dirlisthost"])
+        assert ns["writebackhost"] is None or PROTOCOL_HOST_PORT_RE.fullmatch(ns["writebackhost"])
         credgen = ns["credential_generation"]
         if credgen is not None:
             assert isinstance(credgen["max_scope_depth"], int) and credgen["max_scope_depth"] > -1
             assert credgen["strategy"] in CredentialGeneration.STRATEGIES
             assert credgen["issuer"]
-            parsed_issuer = urllib.parse.urlparse(credgen["issuer"])
-            assert parsed_issuer.netloc and parsed_issuer.scheme == "https"
+            assert ISSUER_RE.match(credgen["issuer"])
             if credgen["vault_server"]:
                 assert isinstance(credgen["vault_server"], str)
             if credgen["vault_issuer"]:
@@ -340,13 +412,11 @@ class TestNamespaces:
         assert "://" in sci["issuer"]
         assert isinstance(sci["base_path"], list)
         assert sci["base_path"]  # must have at least 1
-        for bp in sci["base_path"]:
-            assert bp.startswith("/")  # implies str
-            assert "," not in bp
+        assert all(bp.startswith("/") and "," not in bp  # startswith implies str
+                   for bp in sci["base_path"])
         assert isinstance(sci["restricted_path"], list)
-        for rp in sci["restricted_path"]:  # may be empty
-            assert rp.startswith("/")  # implies str
-            assert "," not in rp
+        assert all(rp.startswith("/") and "," not in rp  # may be empty
+                   for rp in sci["restricted_path"])
 
     def test_issuers_in_namespaces(self, namespaces):
         for namespace in namespaces:
@@ -394,29 +464,23 @@ class TestNamespaces:
         assert sci["base_path"] == [TEST_BASEPATH]
         assert sci["restricted_path"] == []
 
-    def test_caches_include_inactive_param(self, caches, caches_include_inactive):
-        assert TEST_ITB_HELM_CACHE1_RESOURCE not in (
-            x["resource"] for x in caches
-        ), "Inactive cache wrongly present in namespaces JSON without ?include_inactive=1"
-        assert TEST_ITB_HELM_CACHE1_RESOURCE in (
-            x["resource"] for x in caches_include_inactive
-        ), "Inactive cache missing from namespaces JSON with ?include_inactive=1"
-
-    def test_caches_include_downed_param(self, caches, caches_include_downed):
-        assert TEST_ITB_HELM_CACHE2_RESOURCE not in (
-            x["resource"] for x in caches
-        ), "Downed cache wrongly present in namespaces JSON without ?include_downed=1"
-        assert TEST_ITB_HELM_CACHE2_RESOURCE in (
-            x["resource"] for x in caches_include_downed
-        ), "Downed cache missing from namespaces JSON with ?include_downed=1"
-
-    def test_caches_production(self, caches_production, caches_itb):
-        assert "TEST_TIGER_CACHE" in (
-            x["resource"] for x in caches_production
-        ), "Production cache not present in namespaces JSON with production filter"
-        assert "TEST_TIGER_CACHE" not in (
-            x["resource"] for x in caches_itb
-        ), "Production cache wrongly present in namespaces JSON with itb filter"
+    def test_caches_include_inactive_param(self, caches_resources, caches_include_inactive_resources):
+        assert TEST_ITB_HELM_CACHE1_RESOURCE not in caches_resources, \
+            "Inactive cache wrongly present in namespaces JSON without ?include_inactive=1"
+        assert TEST_ITB_HELM_CACHE1_RESOURCE in caches_include_inactive_resources, \
+            "Inactive cache missing from namespaces JSON with ?include_inactive=1"
+
+    def test_caches_include_downed_param(self, caches_resources, caches_include_downed_resources):
+        assert TEST_ITB_HELM_CACHE2_RESOURCE not in caches_resources, \
+            "Downed cache wrongly present in namespaces JSON without ?include_downed=1"
+        assert TEST_ITB_HELM_CACHE2_RESOURCE in caches_include_downed_resources, \
+            "Downed cache missing from namespaces JSON with ?include_downed=1"
+
+    def test_caches_production(self, caches_production_resources, caches_itb_resources):
+        assert "TEST_TIGER_CACHE" in caches_production_resources, \
+            "Production cache not present in namespaces JSON with production filter"
+        assert "TEST_TIGER_CACHE" not in caches_itb_resources, \
+            "Production cache wrongly present in namespaces JSON with itb filter"
 
 
 if __name__ == '__main__':
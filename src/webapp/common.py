@@ -1,13 +1,15 @@
 from collections import OrderedDict
 from logging import getLogger
+import copy
 import hashlib
 import json
 import os
+import pickle
 import re
 import subprocess
 import sys
 from typing import Any, Dict, List, Union, AnyStr, NewType, TypeVar
-from functools import wraps
+from functools import lru_cache, wraps
 
 log = getLogger(__name__)
 
@@ -332,10 +334,14 @@ def gen_id(instr: AnyStr, mod = 2 ** 31 - 1, minimum=1, hashfn=hashlib.md5) -> i
     return minimum + (int(hashfn(instr_b).hexdigest(), 16) % mod)
 
 
-def load_yaml_file(filename) -> ParsedYaml:
-    """Load a yaml file (wrapper around yaml.safe_load() because it does not
-    report the filename in which an error occurred.
-
+# must hold the whole data tree (~2700 YAML files across topology/,
+# virtual-organizations/, projects/ and mappings/) or rebuilds evict
+# everything and the cache never hits
+@lru_cache(maxsize=4096)
+def _load_yaml_file_cached(filename, _mtime_ns, _size) -> ParsedYaml:
+    """Parse a yaml file; cached on (filename, mtime, size) so an unchanged
+    file is only parsed once.  ``_mtime_ns`` and ``_size`` are only used as
+    part of the cache key.
     """
     try:
         with open(filename, encoding='utf-8', errors='surrogateescape') as stream:
@@ -345,6 +351,23 @@ def load_yaml_file(filename) -> ParsedYaml:
         raise
 
 
+def load_yaml_file(filename) -> ParsedYaml:
+    """Load a yaml file (wrapper around yaml.safe_load() because it does not
+    report the filename in which an error occurred.
+
+    Repeated loads of an unchanged file are served from a cache; callers
+    get a copy of the parsed data so they are free to mutate it.
+    """
+    st = os.stat(filename)
+    data = _load_yaml_file_cached(filename, st.st_mtime_ns, st.st_size)
+    # a pickle round-trip clones the plain dict/list graphs that come out of
+    # the YAML parser considerably faster than copy.deepcopy
+    try:
+        return pickle.loads(pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))
+    except (pickle.PicklingError, TypeError):
+        return copy.deepcopy(data)
+
+
 def readfile(path, logger):
     """ return stripped file contents, or None on errors """
     if path: